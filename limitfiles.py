@@ -33,6 +33,54 @@ COMMAND-LINE OPTIONS
     -p PIDFILE, --pidfile=PIDFILE
                           Write the daemon's process ID to the named file.
                           This file must not exist when the daemon starts.
+    -s SOCKET, --socket=SOCKET
+                          Answer control commands on a Unix domain socket
+                          at this path (default: the pidfile's name with
+                          a ``.sock`` extension, if you specify a pidfile)
+    --sweep               Enforce every limit in the configuration once,
+                          print a tab-separated summary of the files and
+                          bytes removed for each section, and exit,
+                          instead of running a daemon.
+    -j JOBS, --jobs=JOBS  With ``--sweep``, scan this many directories at
+                          once (default: chosen by Python's thread pool)
+    --profile-file=PROFILE_FILE
+                          Write profiling results to the named file on
+                          SIGUSR2 (default: the pidfile's name with a
+                          ``.prof`` extension, if you specify a pidfile)
+    --profile-seconds=SECONDS
+                          When profiling starts, also run cProfile for
+                          this many seconds (default 0, which skips it)
+
+SIGNALS
+=======
+
+If the daemon has a profile file, SIGUSR1 turns profiling on or off.
+While profiling is on, limitfiles keeps a histogram of how long each
+watch's event handlers take to run.  SIGUSR2 writes the histograms, and
+any cProfile results, to the profile file.  If it can't, it prints a
+warning and keeps running.  When profiling is off, handlers run without
+any timing overhead.
+
+CONTROL COMMANDS
+================
+
+When the daemon has a control socket, you can query it by running
+``limitfiles.py [options] ctl COMMAND [ARG ...]`` with the same ``-s``
+or ``-p`` option you gave the daemon.  Each response line has
+tab-separated fields.  The daemon understands these commands:
+
+``status``
+    One line per watch: its name, directory, number of indexed files,
+    ``keep`` count, and the count that triggers cleaning.
+``top-oldest N SECTION``
+    The N oldest indexed files in the named watch, as mtime and path.
+``index-size``
+    One line per watch with its name and number of indexed files,
+    followed by a ``total`` line.
+``force-rescan SECTION``
+    Rebuild the named watch's index from a directory listing.
+``flush``
+    Process any queued inotify events immediately.
 
 COPYRIGHT AND LICENSE
 =====================
@@ -56,14 +104,30 @@ COPYRIGHT AND LICENSE
 
 __version__ = '1.1'
 
+import bz2
+import collections
+import concurrent.futures
 import contextlib
+import cProfile
 import errno
+import gzip
+import heapq
 import itertools
+import lzma
+import operator
 import os
+import pstats
 import pyinotify
+import queue
 import re
+import select
+import socket
+import sys
+import tarfile
+import threading
+import time
 
-from stat import S_ISREG
+from stat import S_ISREG, S_ISSOCK
 
 class LimitProcessor(pyinotify.ProcessEvent):
     """Limit the number of files in one directory
@@ -86,20 +150,89 @@ class LimitProcessor(pyinotify.ProcessEvent):
     `match`
       If this is a Python regular expression string, the processor will only
       count and limit files whose names match the regular expression.
+
+    `name`
+      A name for this limit, used to identify it in control commands.
+      The default is `dir_name`.
+
+    `reconcile_rate`
+      If this is a positive number, the processor walks its directory in
+      the background, checking at most this many entries per second, and
+      corrects any files its index missed.  Call tick() periodically to
+      do this work; LimitNotifier does that for you.
+
+    `archiver`
+      An ArchiveWorker.  If given, the processor hands files to it to
+      archive and delete, rather than deleting them itself.  The processor
+      starts the worker from tick(), and collects its results there and
+      before it cleans.  Each processor needs its own worker.
+
+    `free_space`
+      A FreeSpaceMonitor for the directory's filesystem.  When it reports
+      free space below its low watermark, the processor deletes the oldest
+      files until free space reaches its target.
+
+    `poll_interval`, `poll_min_interval`
+      If `poll_interval` is a number of seconds, the processor finds new
+      and deleted files by polling, for filesystems where inotify doesn't
+      see every change.  It checks whether the directory changed at least
+      this often, and as often as every `poll_min_interval` seconds (default
+      1) while it keeps changing.  Call tick() periodically to poll;
+      LimitNotifier does that for you.  If polling fails, the processor
+      prints a warning, keeps its index, and tries again after
+      `poll_interval` seconds.
     """
     _common_errnos = frozenset({errno.ENOENT, errno.EPERM, errno.EACCES})
     _changed_under_errnos = _common_errnos | {errno.ENOTDIR}
+    # Seconds to wait for a file that moved out of an indexed name to move
+    # into a new one.
+    move_timeout = .5
 
-    def my_init(self, dir_name, high, low, match=None):
+    def my_init(self, dir_name, high, low, match=None, name=None,
+                reconcile_rate=0, archiver=None, free_space=None,
+                poll_interval=None, poll_min_interval=1):
         self.dir_name = dir_name
+        self.name = dir_name if name is None else name
         self.min = low
         self.delete_threshold = high - low
+        self.reconcile_rate = reconcile_rate
+        self._last_tick = None
+        self._reconcile_budget = 0
+        self._reconcile_iter = None
+        self._reconcile_seen = set()
+        # Pending moves out, oldest first.  OrderedDict can find its first
+        # entry in O(1), even after many deletes from the front.
+        self._moves = collections.OrderedDict()
+        self.moves_paired = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.group = None
+        self.archiver = archiver
+        # Sizes of files queued with the archiver, by path.
+        self._archiving = {}
+        # True if we stopped cleaning because the archive queue was full.
+        self._archive_full = False
+        self.free_space = free_space
+        self.poll_interval = poll_interval
+        self.poll_min_interval = poll_min_interval
+        self._poll_delay = poll_min_interval
+        self._next_poll = None
+        self._dir_key = None
+        self._poll_failing = False
         if low < 0:
             raise ValueError("low {} must be >= 0".format(low))
         elif high < 0:
             raise ValueError("high {} must be >= 0".format(high))
         elif self.delete_threshold < 0:
             raise ValueError("high {} must be above low {}".format(high, low))
+        elif reconcile_rate < 0:
+            raise ValueError("reconcile_rate {} must be >= 0".
+                             format(reconcile_rate))
+        elif ((poll_interval is not None) and
+              not 0 < poll_min_interval <= poll_interval):
+            raise ValueError("need 0 < poll_min_interval {} <= "
+                             "poll_interval {}".
+                             format(poll_min_interval, poll_interval))
         elif match is None:
             self.match = lambda name: True
         else:
@@ -117,11 +250,15 @@ class LimitProcessor(pyinotify.ProcessEvent):
                               skip_errors=_changed_under_errnos):
         # Scan the whole directory for matching files and record their mtimes.
         self.files = {}
+        self.sizes = {}
+        self.total_bytes = 0
+        self._heap = []
         listing = []
         with self._skip_os_errors(skip_errors):
-            listing = os.listdir(self.dir_name)
-        for filename in listing:
-            self._record_file(filename)
+            with os.scandir(self.dir_name) as entries:
+                listing = list(entries)
+        for entry in listing:
+            self._record_file(entry.name, entry)
         self._clean_files()
 
     @contextlib.contextmanager
@@ -134,35 +271,288 @@ class LimitProcessor(pyinotify.ProcessEvent):
             if error.errno not in errnos:
                 raise
 
-    def _record_file(self, filename):
-        # Find and save one file's mtime.
+    def _record_file(self, filename, entry=None):
+        # Find and save one file's mtime.  If the caller has an os.DirEntry
+        # for the file, use its stat method.
         if not self.match(filename):
             return
         path = os.path.join(self.dir_name, filename)
         with self._skip_os_errors():
-            stats = os.stat(path)
+            stats = os.stat(path) if (entry is None) else entry.stat()
             if S_ISREG(stats.st_mode):
-                self.files[path] = stats.st_mtime
+                self._index_file(path, stats.st_mtime, stats.st_size)
+
+    def _index_file(self, path, mtime, size):
+        # Save one file's mtime and size in the index.
+        self.total_bytes += size - self.sizes.get(path, 0)
+        if self.files.get(path) != mtime:
+            self.files[path] = mtime
+            self._push_heap(mtime, path)
+        self.sizes[path] = size
+
+    def _push_heap(self, mtime, path):
+        # Add a file to the heap behind iter_oldest().  Entries for files
+        # that were since forgotten or modified stay in the heap until they
+        # reach the top, so rebuild it when they make up most of it.
+        if len(self._heap) > (2 * len(self.files)) + 64:
+            self._heap = [(mtime, path) for path, mtime in self.files.items()]
+            heapq.heapify(self._heap)
+        else:
+            heapq.heappush(self._heap, (mtime, path))
+
+    def _forget_file(self, path):
+        # Remove one file from the index.  Raises KeyError if it's not there.
+        del self.files[path]
+        self.total_bytes -= self.sizes.pop(path, 0)
+
+    def remove_file(self, path):
+        """Delete one indexed file and remove it from the index
+
+        If the processor has an archiver, queue the file to be archived and
+        deleted instead.  Returns False if the archiver's queue is full, and
+        the file was left in place; True otherwise.  Raises OSError if the
+        file can't be deleted.  If the archiver later leaves a queued file
+        in place, the processor indexes it again.
+        """
+        size = self.sizes.get(path, 0)
+        if self.archiver is None:
+            os.unlink(path)
+            self._count_removal(size)
+        elif not self.archiver.submit(path):
+            self._archive_full = True
+            return False
+        else:
+            self._archiving[path] = size
+        self._forget_file(path)
+        return True
+
+    def _count_removal(self, size):
+        # Record that we deleted a file of the given size.
+        self.removed_files += 1
+        self.removed_bytes += size
 
     def _clean_files(self):
         # Check if the number of files is above the maximum.  If so,
-        # delete the oldest until we reach the floor.
-        deletes_left = len(self.files) - self.min
-        if deletes_left < self.delete_threshold:
-            return
-        sorted_names = sorted(self.files.keys(), key=self.files.get)
-        for path in itertools.takewhile(lambda x: deletes_left > 0,
-                                        sorted_names):
-            with self._skip_os_errors():
-                os.unlink(path)
-                del self.files[path]
-                deletes_left -= 1
-        # Check how many files are left.  If there are still enough to trigger
-        # cleaning, that means the OS won't let us enforce the limit.  Modify
-        # the limit to compensate.
-        deletes_left = len(self.files) - self.min
-        if deletes_left >= self.delete_threshold:
-            self.delete_threshold = deletes_left + 1
+        # delete the oldest until we reach the floor.  Then do the same if
+        # free space is below the low watermark, and let our group enforce
+        # its limit.
+        self._collect_archived()
+        if (len(self.files) - self.min >= self.delete_threshold and
+              self._delete_oldest(lambda: len(self.files) <= self.min)):
+            # Check how many files are left.  If there are still enough to
+            # trigger cleaning, that means the OS won't let us enforce the
+            # limit.  Modify the limit to compensate.
+            deletes_left = len(self.files) - self.min
+            if deletes_left >= self.delete_threshold:
+                self.delete_threshold = deletes_left + 1
+        free_space = self.free_space
+        if free_space is not None:
+            with self._skip_os_errors(self._changed_under_errnos):
+                if (free_space.free_bytes(self.total_bytes) <
+                      free_space.min_free):
+                    self._delete_oldest(
+                        lambda: (free_space.free_bytes(self.total_bytes) >=
+                                 free_space.target_free))
+        if self.group is not None:
+            self.group.enforce()
+
+    def _delete_oldest(self, done):
+        # Delete the oldest files until done() returns true.  Return False
+        # if we had to stop early because the archive queue is full.
+        with contextlib.closing(self.iter_oldest()) as oldest:
+            for mtime, path in oldest:
+                if done():
+                    break
+                with self._skip_os_errors():
+                    if not self.remove_file(path):
+                        return False
+        return True
+
+    def tick(self, now):
+        """Do periodic background work
+
+        `now` is the current time.monotonic().  Returns the number of
+        seconds until the processor next has work to do, or None if it
+        has no periodic work.
+        """
+        delays = [delay for delay in [self._tick_archive(),
+                                      self._expire_moves(now),
+                                      self._tick_reconcile(now),
+                                      self._tick_poll(now)]
+                  if delay is not None]
+        return min(delays) if delays else None
+
+    def _tick_archive(self):
+        # Start the archiver and collect its results.  If it deleted files,
+        # or the queue has room again after we filled it, clean again in
+        # case we're still over a limit.  While it has files of ours, or
+        # we're waiting for room, check back soon.
+        if self.archiver is None:
+            return None
+        self.archiver.start()
+        if (self._collect_archived() or
+              (self._archive_full and not self.archiver.queue.full())):
+            self._archive_full = False
+            self._clean_files()
+        return .1 if (self._archiving or self._archive_full) else None
+
+    def _collect_archived(self):
+        # Catch up with the files the archiver finished.  Index the ones it
+        # left in place again, so the limits still count them.  Return the
+        # number of files it deleted.
+        if self.archiver is None:
+            return 0
+        deleted_count = 0
+        for path, deleted in self.archiver.collect():
+            size = self._archiving.pop(path, None)
+            if size is None:
+                continue
+            elif not deleted:
+                self._record_file(os.path.basename(path))
+            else:
+                deleted_count += 1
+                self._count_removal(size)
+                if path in self.files:
+                    self._forget_file(path)
+        return deleted_count
+
+    def _expire_moves(self, now):
+        # Forget files that moved out of the directory more than
+        # move_timeout seconds ago without a matching move in.  Return the
+        # number of seconds until the next one expires.  Moves are in the
+        # order they happened, so stop at the first one that's still live.
+        while self._moves:
+            cookie = next(iter(self._moves))
+            delay = self._moves[cookie][0] + self.move_timeout - now
+            if delay > 0:
+                return delay
+            del self._moves[cookie]
+        return None
+
+    def _tick_reconcile(self, now):
+        if not self.reconcile_rate:
+            return None
+        if self._last_tick is not None:
+            elapsed = min(now - self._last_tick, 1)
+            self._reconcile_budget += self.reconcile_rate * elapsed
+        self._last_tick = now
+        entry_count = int(self._reconcile_budget)
+        if entry_count > 0:
+            self._reconcile_budget -= entry_count
+            self._reconcile(entry_count)
+        return max(.1, 1 / self.reconcile_rate)
+
+    def _tick_poll(self, now):
+        # Poll the directory if it's time.  Poll more often while it keeps
+        # changing, and back off while it doesn't.
+        if self.poll_interval is None:
+            return None
+        elif (self._next_poll is not None) and (now < self._next_poll):
+            return self._next_poll - now
+        try:
+            changed = self._poll()
+        except OSError as error:
+            # The network and FUSE filesystems we poll fail in more ways
+            # than local ones, with errors like ESTALE, EIO, or ETIMEDOUT.
+            # Don't let one bad mount stop the daemon.  Warn once per
+            # failure streak, keep the index, and back off.
+            if not ((error.errno in self._changed_under_errnos) or
+                    self._poll_failing):
+                print("limitfiles warning: can't poll {}: {}".
+                      format(self.dir_name, error), file=sys.stderr)
+            self._poll_failing = True
+            self._poll_delay = self.poll_interval
+        else:
+            self._poll_failing = False
+            if changed:
+                self._poll_delay = max(self.poll_min_interval,
+                                       self._poll_delay / 2)
+            else:
+                self._poll_delay = min(self.poll_interval,
+                                       self._poll_delay * 2)
+        self._next_poll = now + self._poll_delay
+        return self._poll_delay
+
+    def _poll(self):
+        # If the directory changed since the last poll, list it, and update
+        # the index for files that appeared or disappeared.  Clean files
+        # once after the whole batch, like an overflow rescan, so the
+        # listing order doesn't decide which files get deleted.
+        # Return True if the directory changed.
+        scan_time = time.time()
+        stats = os.stat(self.dir_name)
+        dir_key = (stats.st_mtime_ns, stats.st_ino)
+        if dir_key == self._dir_key:
+            return False
+        # Some filesystems only store mtimes to the second.  If the
+        # directory changed very recently, it might change again without
+        # its mtime changing, so make sure the next poll lists it again.
+        if stats.st_mtime < scan_time - 1:
+            self._dir_key = dir_key
+        else:
+            self._dir_key = None
+        listed = {}
+        with os.scandir(self.dir_name) as entries:
+            for entry in entries:
+                if self.match(entry.name) and entry.is_file():
+                    listed[entry.path] = entry
+        for path in [path for path in self.files if path not in listed]:
+            self._forget_file(path)
+        for path, entry in listed.items():
+            if path not in self.files:
+                self._record_file(entry.name, entry)
+        self._clean_files()
+        return True
+
+    def _reconcile(self, entry_count):
+        # Check up to entry_count more directory entries against the index.
+        # When a pass over the directory finishes, drop indexed files that
+        # the pass did not see and that no longer exist.
+        if self._reconcile_iter is None:
+            self._reconcile_seen.clear()
+            with self._skip_os_errors(self._changed_under_errnos):
+                self._reconcile_iter = os.scandir(self.dir_name)
+            if self._reconcile_iter is None:
+                return
+        checked = 0
+        for entry in itertools.islice(self._reconcile_iter, entry_count):
+            checked += 1
+            self._reconcile_seen.add(entry.path)
+            self._record_file(entry.name, entry)
+        if checked < entry_count:
+            self._reconcile_iter.close()
+            self._reconcile_iter = None
+            for path in [path for path in self.files
+                         if path not in self._reconcile_seen]:
+                if not os.path.exists(path):
+                    self._forget_file(path)
+        self._clean_files()
+
+    def oldest(self, count):
+        """Return a list of (path, mtime) pairs for the oldest `count` files"""
+        return heapq.nsmallest(count, self.files.items(),
+                               key=operator.itemgetter(1))
+
+    def iter_oldest(self):
+        """Iterate over (mtime, path) pairs for indexed files, oldest first
+
+        This pops files from a heap that the processor maintains as it
+        indexes them, so each step costs O(log n).  When the iterator is
+        closed or exhausted, files that are still indexed go back on the
+        heap.  Don't index files while iterating.
+        """
+        heap = self._heap
+        popped = []
+        try:
+            while heap:
+                mtime, path = heapq.heappop(heap)
+                if self.files.get(path) == mtime:
+                    popped.append((mtime, path))
+                    yield mtime, path
+        finally:
+            for mtime, path in popped:
+                if self.files.get(path) == mtime:
+                    heapq.heappush(heap, (mtime, path))
 
     def process_IN_CREATE(self, event):
         self._record_file(event.name)
@@ -170,15 +560,420 @@ class LimitProcessor(pyinotify.ProcessEvent):
 
     process_IN_ATTRIB = process_IN_CREATE
     process_IN_MODIFY = process_IN_CREATE
-    process_IN_MOVED_TO = process_IN_CREATE
+
+    def process_IN_MOVED_TO(self, event):
+        # If we saw this file move out of an indexed name, reuse its index
+        # entry instead of statting it again.  rename() doesn't change mtime.
+        self._expire_moves(time.monotonic())
+        try:
+            moved_at, (mtime, size) = self._moves.pop(event.cookie)
+        except (AttributeError, KeyError):
+            self.process_IN_CREATE(event)
+            return
+        if self.match(event.name):
+            self._index_file(os.path.join(self.dir_name, event.name),
+                             mtime, size)
+            self.moves_paired += 1
+            self._clean_files()
 
     def process_IN_DELETE(self, event):
         try:
-            del self.files[event.pathname]
+            self._forget_file(event.pathname)
+        except KeyError:
+            pass
+
+    def process_IN_MOVED_FROM(self, event):
+        # Remove the file from the index, but remember its entry in case it
+        # moves to another name in this directory.  Expire old moves here
+        # too, in case nothing calls tick().
+        now = time.monotonic()
+        self._expire_moves(now)
+        path = event.pathname
+        try:
+            entry = (self.files[path], self.sizes.get(path, 0))
+            self._forget_file(path)
         except KeyError:
+            return
+        self._moves[event.cookie] = (now, entry)
+        self._moves.move_to_end(event.cookie)
+
+
+class FreeSpaceMonitor:
+    """Estimate free space on a filesystem without a syscall per check
+
+    This calls statvfs at most once every `interval` seconds.  In between,
+    it estimates free space by adjusting the last result by how much the
+    caller's files have grown or shrunk since then.
+
+    Required arguments:
+
+    `path`
+      A path on the filesystem to check.
+
+    Optional arguments:
+
+    `min_free_bytes`, `min_free_percent`
+      The low watermark.  Free space is low when it's below either of
+      these.
+
+    `target_free_bytes`, `target_free_percent`
+      How much space to free when it's low.  These default to the
+      corresponding minimums.
+
+    `interval`
+      The most seconds to go without calling statvfs.
+    """
+    def __init__(self, path, min_free_bytes=0, min_free_percent=0,
+                 target_free_bytes=None, target_free_percent=None,
+                 interval=1):
+        if target_free_bytes is None:
+            target_free_bytes = min_free_bytes
+        if target_free_percent is None:
+            target_free_percent = min_free_percent
+        if min_free_bytes < 0:
+            raise ValueError("min_free_bytes {} must be >= 0".
+                             format(min_free_bytes))
+        elif target_free_bytes < min_free_bytes:
+            raise ValueError("target_free_bytes {} must be at least "
+                             "min_free_bytes {}".
+                             format(target_free_bytes, min_free_bytes))
+        elif not 0 <= min_free_percent <= target_free_percent <= 100:
+            raise ValueError("need 0 <= min_free_percent {} <= "
+                             "target_free_percent {} <= 100".
+                             format(min_free_percent, target_free_percent))
+        self.path = path
+        self.min_free_bytes = min_free_bytes
+        self.min_free_percent = min_free_percent
+        self.target_free_bytes = target_free_bytes
+        self.target_free_percent = target_free_percent
+        self.interval = interval
+        self._refreshed_at = None
+
+    def refresh(self, used_bytes):
+        """Check free space with statvfs
+
+        `used_bytes` is how much space the caller's files use now.
+        """
+        stats = os.statvfs(self.path)
+        size = stats.f_blocks * stats.f_frsize
+        self.min_free = max(self.min_free_bytes,
+                            size * self.min_free_percent / 100)
+        self.target_free = max(self.target_free_bytes,
+                               size * self.target_free_percent / 100)
+        self._free_at_refresh = stats.f_bavail * stats.f_frsize
+        self._used_at_refresh = used_bytes
+        self._refreshed_at = time.monotonic()
+
+    def free_bytes(self, used_bytes):
+        """Return the estimated free space in bytes
+
+        `used_bytes` is how much space the caller's files use now.  This
+        also sets the `min_free` and `target_free` attributes to the low
+        watermark and target in bytes.
+        """
+        if ((self._refreshed_at is None) or
+              (time.monotonic() - self._refreshed_at >= self.interval)):
+            self.refresh(used_bytes)
+        return self._free_at_refresh - (used_bytes - self._used_at_refresh)
+
+
+class LimitGroup:
+    """Limit the combined size of files across several LimitProcessors
+
+    When the total size of all the files indexed by the group's members
+    goes over `max_bytes`, the group deletes the oldest files across all
+    members until the total is at or below `keep_bytes`.  Processors join
+    a group through add(), or LimitManager.add_watch()'s `group` argument.
+
+    Required arguments:
+
+    `name`
+      A name for the group.
+
+    `max_bytes`
+      The combined size in bytes that triggers cleaning.
+
+    Optional arguments:
+
+    `keep_bytes`
+      The combined size in bytes to clean down to.  The default is 90% of
+      `max_bytes`, so the group doesn't clean again every time a member
+      writes a file.
+    """
+    def __init__(self, name, max_bytes, keep_bytes=None):
+        if keep_bytes is None:
+            keep_bytes = max_bytes - (max_bytes // 10)
+        if keep_bytes < 0:
+            raise ValueError("keep_bytes {} must be >= 0".format(keep_bytes))
+        elif max_bytes < keep_bytes:
+            raise ValueError("max_bytes {} must be at least keep_bytes {}".
+                             format(max_bytes, keep_bytes))
+        self.name = name
+        self.max_bytes = max_bytes
+        self.keep_bytes = keep_bytes
+        self.members = []
+
+    def add(self, processor):
+        """Make a LimitProcessor a member of this group"""
+        processor.group = self
+        self.members.append(processor)
+
+    @property
+    def total_bytes(self):
+        return sum(processor.total_bytes for processor in self.members)
+
+    def enforce(self):
+        """Delete the group's oldest files if it's over its size limit"""
+        total = self.total_bytes
+        if total <= self.max_bytes:
+            return
+        # Merge each member's files, oldest first.  Every member keeps its
+        # own heap, and heapq.merge only keeps each member's head in its
+        # heap, so deleting k files costs O((members + k) log n).
+        with contextlib.ExitStack() as stack:
+            oldest = heapq.merge(*[
+                zip(stack.enter_context(
+                    contextlib.closing(processor.iter_oldest())),
+                    itertools.repeat(index))
+                for index, processor in enumerate(self.members)])
+            for (mtime, path), index in oldest:
+                if total <= self.keep_bytes:
+                    break
+                processor = self.members[index]
+                size = processor.sizes.get(path, 0)
+                with processor._skip_os_errors():
+                    if not processor.remove_file(path):
+                        return
+                    total -= size
+        # As with LimitProcessor's count limit, if the OS won't let us
+        # delete enough files, raise the limit to compensate.
+        if total > self.max_bytes:
+            self.max_bytes = total
+
+
+class ArchiveWorker:
+    """Archive files in a background thread before deleting them
+
+    This collects files queued with submit() into batches.  It writes each
+    batch to a new compressed tar archive, and deletes the files only after
+    the archive is safely on disk.  Files that can't be read are left in
+    place.  If a file changes while it's being written to the archive, the
+    worker discards that archive and leaves the whole batch in place.
+
+    Required arguments:
+
+    `archive_dir`
+      The directory to write archives in.
+
+    Optional arguments:
+
+    `compression`
+      One of ``gz`` (the default), ``bz2``, ``xz``, or ``zst``.  ``zst``
+      needs the third-party `zstandard` module.
+
+    `prefix`
+      The start of each archive's filename.
+
+    `queue_size`
+      The most files that can wait to be archived.  When the queue is
+      full, submit() returns False rather than blocking.
+
+    `batch_size`
+      The most files to write to one archive.
+
+    Call collect() to learn which queued files were deleted.
+    """
+    compressions = frozenset({'gz', 'bz2', 'xz', 'zst'})
+    copy_bufsize = 1 << 20
+
+    def __init__(self, archive_dir, compression='gz', prefix='limitfiles',
+                 queue_size=10000, batch_size=1000):
+        if compression not in self.compressions:
+            raise ValueError("unknown archive compression {!r}".
+                             format(compression))
+        elif compression == 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zst archives need the zstandard module")
+        if queue_size < 1:
+            raise ValueError("queue_size {} must be >= 1".format(queue_size))
+        self.archive_dir = archive_dir
+        self.compression = compression
+        self.prefix = re.sub(r'[^\w.-]+', '_', prefix)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.pending = set()
+        self._results = collections.deque()
+        self._serial = itertools.count()
+        self._thread_pid = None
+
+    def start(self):
+        """Start the worker thread, if it's not running in this process"""
+        if self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name=self.prefix,
+                             daemon=True).start()
+
+    def submit(self, path):
+        """Queue one file to be archived and deleted
+
+        Returns True if the file is queued, or False if the queue is full.
+        """
+        if path in self.pending:
+            return True
+        self.pending.add(path)
+        try:
+            self.queue.put_nowait(path)
+        except queue.Full:
+            self.pending.discard(path)
+            return False
+        return True
+
+    def collect(self):
+        """Return results for the files the worker finished since last time
+
+        This returns a list of (path, deleted) pairs.  `deleted` is True if
+        the file was archived and deleted, or False if it was left in
+        place.  Results are ready before queue.join() returns.
+        """
+        results = []
+        while self._results:
+            results.append(self._results.popleft())
+        return results
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            deleted = set()
+            try:
+                deleted = self._archive_batch(batch)
+            finally:
+                for path in batch:
+                    self._results.append((path, path in deleted))
+                    self.pending.discard(path)
+                    self.queue.task_done()
+
+    def _open_archive(self, raw_file):
+        # Return a writable, compressing file object around raw_file.
+        if self.compression == 'gz':
+            return gzip.GzipFile(fileobj=raw_file, mode='wb')
+        elif self.compression == 'bz2':
+            return bz2.BZ2File(raw_file, 'wb')
+        elif self.compression == 'xz':
+            return lzma.LZMAFile(raw_file, 'wb')
+        else:
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(raw_file,
+                                                            closefd=False)
+
+    def _archive_batch(self, batch):
+        # Write the files in batch to a new archive, then delete the ones
+        # that made it in.  Return the set of paths that were deleted.
+        try:
+            part_name, raw_fd = self._create_part()
+        except OSError:
+            return set()
+        archived = []
+        try:
+            with open(raw_fd, 'wb') as raw_file:
+                with self._open_archive(raw_file) as stream:
+                    with tarfile.open(fileobj=stream, mode='w|',
+                                      copybufsize=self.copy_bufsize) as tar:
+                        for path in batch:
+                            if self._add_file(tar, path):
+                                archived.append(path)
+                raw_file.flush()
+                os.fsync(raw_file.fileno())
+            if archived:
+                self._publish(part_name)
+        except OSError:
+            # We couldn't write a complete archive, so leave all the files
+            # alone.
+            archived = []
+        if not archived:
+            try:
+                os.unlink(part_name)
+            except OSError:
+                pass
+        deleted = set()
+        for path in archived:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            else:
+                deleted.add(path)
+        return deleted
+
+    def _next_name(self, suffix):
+        # Return a path in the archive directory that no other worker in
+        # this process, or any other process, will pick right now.
+        return os.path.join(self.archive_dir, '{}-{}-{}-{}{}'.format(
+            self.prefix, time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+            next(self._serial), suffix))
+
+    def _create_part(self):
+        # Create a new, empty .part file to write an archive in, and return
+        # its path and a file descriptor open for writing.  Sections can
+        # share a prefix and archive directory, so never open an existing
+        # file.
+        while True:
+            part_name = self._next_name('.part')
+            try:
+                return part_name, os.open(
+                    part_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                pass
+
+    def _publish(self, part_name):
+        # Give a finished archive its final name.  link() fails if that
+        # name is taken, where rename() would replace an archive whose
+        # sources are already gone, so try new names until one is free.
+        while True:
+            try:
+                os.link(part_name, self._next_name(
+                    '.tar.' + self.compression))
+            except FileExistsError:
+                continue
+            break
+        try:
+            os.unlink(part_name)
+        except OSError:
             pass
 
-    process_IN_MOVED_FROM = process_IN_DELETE
+    def _add_file(self, tar, path):
+        # Add one file to the archive, reading it in large sequential
+        # chunks.  Return True if it was archived, or False if it couldn't
+        # be opened, before anything was written for it.  Once tar has
+        # written the file's header, errors propagate: the archive is no
+        # good, and the caller must discard the whole batch.
+        try:
+            source = open(path, 'rb')
+        except OSError:
+            return False
+        with source:
+            try:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(source.fileno(), 0, 0,
+                                     os.POSIX_FADV_SEQUENTIAL)
+                tarinfo = tar.gettarinfo(arcname=os.path.basename(path),
+                                         fileobj=source)
+            except OSError:
+                return False
+            # addfile raises OSError if the file shrinks.  If it grew or
+            # was rewritten, the archive has a stale copy.
+            tar.addfile(tarinfo, source)
+            stats = os.fstat(source.fileno())
+            if ((stats.st_size != tarinfo.size) or
+                  (stats.st_mtime != tarinfo.mtime)):
+                raise OSError("{} changed while it was archived".format(path))
+        return True
 
 
 class LimitManager(pyinotify.WatchManager):
@@ -186,13 +981,19 @@ class LimitManager(pyinotify.WatchManager):
 
     This is a subclass of pyinotify.WatchManager with a new add_watch method
     that creates a LimitProcessor and installs it with the right event mask.
+    Successfully watched processors are available by name in the
+    `processors` attribute.
     """
     mask = pyinotify.IN_ONLYDIR | pyinotify.IN_Q_OVERFLOW
     for method in (name.split('_', 1)[1] for name in dir(LimitProcessor)
                    if name.startswith('process_')):
         mask |= pyinotify.EventsCodes.OP_FLAGS.get(method, 0)
 
-    def add_watch(self, path, **kwargs):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.processors = collections.OrderedDict()
+
+    def add_watch(self, path, group=None, **kwargs):
         """Watch one directory with a LimitProcessor
 
         This method creates a new LimitProcessor with the given arguments,
@@ -201,15 +1002,372 @@ class LimitManager(pyinotify.WatchManager):
 
         Pass the name of the directory to watch as the first argument.  Refer
         to the LimitProcessor documentation for other keyword arguments you
-        can specify.  Returns the result of WatchManager.add_watch().
+        can specify.  Returns the result of WatchManager.add_watch().  If
+        you pass a `poll_interval`, the processor polls the directory
+        instead, and this returns ``{path: None}`` without adding a watch.
+        If you pass a LimitGroup as `group`, the processor joins it once
+        the directory is being watched.
         """
         processor = LimitProcessor(dir_name=path, **kwargs)
-        return super().add_watch(path, self.mask, processor)
+        if processor.poll_interval is not None:
+            result = {path: None}
+        else:
+            result = super().add_watch(path, self.mask, processor)
+            if result.get(path, -1) < 0:
+                return result
+        self.processors[processor.name] = processor
+        if group is not None:
+            group.add(processor)
+        return result
+
+
+class LimitNotifier(pyinotify.Notifier):
+    """Notifier that can serve other file descriptors from its event loop
+
+    This is a subclass of pyinotify.Notifier.  Other objects can register
+    file descriptors with add_handler, and the notifier will call their
+    handlers when those descriptors are ready, in between processing
+    inotify events.  After every poll, it calls tick() on each of the
+    watch manager's processors, and wakes up in time for the next one.
+    """
+    def __init__(self, watch_manager, *args, **kwargs):
+        super().__init__(watch_manager, *args, **kwargs)
+        self.watch_manager = watch_manager
+        self._fd_handlers = {}
+        self._tick_timeout = 0
+
+    def add_handler(self, fd, handler, eventmask=select.POLLIN):
+        """Call `handler(fd, eventmask)` when `fd` is ready"""
+        self._fd_handlers[fd] = handler
+        self._pollobj.register(fd, eventmask)
+
+    def modify_handler(self, fd, eventmask):
+        """Change the poll events to wait for on a registered `fd`"""
+        self._pollobj.modify(fd, eventmask)
+
+    def remove_handler(self, fd):
+        """Stop polling a registered `fd`"""
+        del self._fd_handlers[fd]
+        self._pollobj.unregister(fd)
+
+    def check_events(self, timeout=None):
+        # Dispatch any ready descriptors besides inotify's to their handlers.
+        # Return true if inotify events are ready to read.
+        if timeout is None:
+            timeout = self._tick_timeout
+        inotify_ready = False
+        for fd, eventmask in self._pollobj.poll(timeout):
+            if fd == self._fd:
+                inotify_ready = bool(eventmask & select.POLLIN)
+            elif fd in self._fd_handlers:
+                self._fd_handlers[fd](fd, eventmask)
+        self._tick_timeout = self.run_ticks()
+        return inotify_ready
+
+    def run_ticks(self):
+        """Call tick() on every processor
+
+        Returns the poll timeout in milliseconds until the next processor
+        wants a tick, or the notifier's own timeout if that's sooner.
+        """
+        now = time.monotonic()
+        delays = [delay for delay in
+                  (processor.tick(now) for processor in
+                   self.watch_manager.processors.values())
+                  if delay is not None]
+        if self._timeout is not None:
+            delays.append(self._timeout / 1000)
+        return int(min(delays) * 1000) if delays else None
+
+    def flush_events(self):
+        """Read and process any queued inotify events immediately"""
+        if select.select([self._fd], [], [], 0)[0]:
+            self.read_events()
+        self.process_events()
+
+
+class ControlServer:
+    """Answer control commands about running limits on a Unix domain socket
+
+    This listens on a Unix domain socket, and serves clients from a
+    LimitNotifier's event loop without blocking it.  Each client sends one
+    command line, and the server replies and closes the connection.  Refer
+    to the module documentation for the available commands.
+
+    Required arguments:
+
+    `path`
+      The path of the socket to create.  If a stale socket already exists
+      at this path, it is replaced.  If another process is still accepting
+      connections on it, this raises OSError with errno EADDRINUSE.
+
+    `notifier`
+      The LimitNotifier to serve from.  Its watch manager must be a
+      LimitManager.
+    """
+    max_request = 4096
+
+    def __init__(self, path, notifier):
+        self.path = path
+        self.notifier = notifier
+        self.processors = notifier.watch_manager.processors
+        self._clients = {}
+        try:
+            if S_ISSOCK(os.lstat(path).st_mode):
+                self._remove_stale(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.bind(path)
+        self.socket.listen(8)
+        notifier.add_handler(self.socket.fileno(), self._accept)
+
+    @staticmethod
+    def _remove_stale(path):
+        # Unlink a socket that was left behind, but not one that another
+        # daemon is still serving.
+        with contextlib.closing(socket.socket(socket.AF_UNIX,
+                                              socket.SOCK_STREAM)) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            else:
+                raise OSError(errno.EADDRINUSE,
+                              "another process is listening", path)
+
+    def close(self):
+        """Disconnect all clients and remove the socket"""
+        for fd in list(self._clients):
+            self._close_client(fd)
+        self.notifier.remove_handler(self.socket.fileno())
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    def _accept(self, fd, eventmask):
+        try:
+            client, _ = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        client.setblocking(False)
+        self._clients[client.fileno()] = [client, b'', b'']
+        self.notifier.add_handler(client.fileno(), self._serve,
+                                  select.POLLIN)
+
+    def _close_client(self, fd):
+        self.notifier.remove_handler(fd)
+        self._clients.pop(fd)[0].close()
+
+    def _serve(self, fd, eventmask):
+        # Each client record is [socket, received bytes, bytes to send].
+        record = self._clients[fd]
+        client = record[0]
+        try:
+            if eventmask & select.POLLOUT:
+                record[2] = record[2][client.send(record[2]):]
+                if not record[2]:
+                    self._close_client(fd)
+                return
+            elif not eventmask & select.POLLIN:
+                self._close_client(fd)
+                return
+            data = client.recv(self.max_request)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close_client(fd)
+            return
+        record[1] += data
+        if b'\n' in record[1]:
+            line = record[1].split(b'\n', 1)[0]
+        elif not data or (len(record[1]) >= self.max_request):
+            line = record[1]
+        else:
+            return
+        reply = self.run_command(line.decode('utf-8', 'replace'))
+        record[2] = reply.encode('utf-8')
+        self.notifier.modify_handler(fd, select.POLLOUT)
+
+    def run_command(self, line):
+        """Run one control command line and return the text of the reply"""
+        words = line.split(None, 1)
+        if not words:
+            return "error: no command\n"
+        method = getattr(self, 'do_' + words[0].replace('-', '_'), None)
+        if method is None:
+            return "error: unknown command {!r}\n".format(words[0])
+        try:
+            lines = list(method(words[1] if len(words) > 1 else ''))
+        except ValueError as error:
+            return "error: {}\n".format(error)
+        return ''.join('\t'.join(str(field) for field in fields) + '\n'
+                       for fields in lines)
+
+    def _processor(self, name):
+        name = name.strip()
+        try:
+            return self.processors[name]
+        except KeyError:
+            raise ValueError("no watch named {!r}".format(name))
+
+    def do_status(self, arg):
+        for name, processor in self.processors.items():
+            yield (name, processor.dir_name, len(processor.files),
+                   processor.min, processor.min + processor.delete_threshold)
+
+    def do_top_oldest(self, arg):
+        try:
+            count, name = arg.split(None, 1)
+            count = int(count)
+        except ValueError:
+            raise ValueError("usage: top-oldest N SECTION")
+        for path, mtime in self._processor(name).oldest(count):
+            yield mtime, path
+
+    def do_index_size(self, arg):
+        total = 0
+        for name, processor in self.processors.items():
+            total += len(processor.files)
+            yield name, len(processor.files)
+        yield 'total', total
+
+    def do_force_rescan(self, arg):
+        processor = self._processor(arg)
+        processor.process_IN_Q_OVERFLOW()
+        yield 'ok', len(processor.files)
+
+    def do_flush(self, arg):
+        self.notifier.flush_events()
+        yield 'ok',
+
+
+class HandlerProfiler:
+    """Time LimitProcessor handlers while the daemon runs
+
+    While enabled, this replaces each processor's handler methods with
+    timed wrappers, and keeps a histogram of their run times for each
+    watch and handler.  Disabling it removes the wrappers, so handlers
+    run with no added overhead.
+
+    Required arguments:
+
+    `processors`
+      A mapping of names to the LimitProcessors to profile, like
+      LimitManager's `processors` attribute.
+
+    Optional arguments:
+
+    `cprofile_seconds`
+      If this is a positive number, each time profiling is enabled, also
+      run cProfile for this many seconds, and include its results in the
+      dump.
+    """
+    handler_names = ('process_IN_CREATE', 'process_IN_ATTRIB',
+                     'process_IN_MODIFY', 'process_IN_MOVED_TO',
+                     'process_IN_MOVED_FROM', 'process_IN_DELETE',
+                     'process_IN_Q_OVERFLOW', '_clean_files', 'tick')
+
+    def __init__(self, processors, cprofile_seconds=0):
+        self.processors = processors
+        self.cprofile_seconds = cprofile_seconds
+        self.enabled = False
+        self.timings = collections.OrderedDict()
+        self._cprofile = None
+        self._cprofile_until = None
+
+    def toggle(self):
+        """Enable profiling if it's disabled, or disable it if it's enabled"""
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def enable(self):
+        """Start timing handlers"""
+        if self.enabled:
+            return
+        self.enabled = True
+        for name, processor in self.processors.items():
+            for handler_name in self.handler_names:
+                setattr(processor, handler_name, self._timed(
+                    getattr(processor, handler_name), (name, handler_name)))
+        if self.cprofile_seconds > 0:
+            self._cprofile = cProfile.Profile()
+            self._cprofile_until = time.monotonic() + self.cprofile_seconds
+            self._cprofile.enable()
+
+    def disable(self):
+        """Stop timing handlers, and restore the original methods"""
+        if not self.enabled:
+            return
+        self.enabled = False
+        for processor in self.processors.values():
+            for handler_name in self.handler_names:
+                processor.__dict__.pop(handler_name, None)
+        self._stop_cprofile()
+
+    def _stop_cprofile(self):
+        if self._cprofile_until is not None:
+            self._cprofile.disable()
+            self._cprofile_until = None
+
+    def _timed(self, method, key):
+        # Return a wrapper for method that adds its run time in
+        # microseconds to the histogram for key.  Histogram bucket N counts
+        # calls that took less than 2**N microseconds.
+        timing = self.timings.setdefault(key, [0, 0, 0, collections.Counter()])
+        def timed_method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                micros = int((end - start) * 1000000)
+                timing[0] += 1
+                timing[1] += micros
+                timing[2] = max(timing[2], micros)
+                timing[3][micros.bit_length()] += 1
+                if ((self._cprofile_until is not None) and
+                      (time.monotonic() >= self._cprofile_until)):
+                    self._stop_cprofile()
+        return timed_method
+
+    def dump(self, path):
+        """Write profiling results to the named file
+
+        Each timing line has tab-separated fields: the watch name, handler
+        name, number of calls, and total and maximum microseconds, followed
+        by histogram buckets formatted as ``<MICROSECONDS:CALLS``.
+        """
+        if ((self._cprofile_until is not None) and
+              (time.monotonic() >= self._cprofile_until)):
+            self._stop_cprofile()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as dump_file:
+            for (name, handler_name), timing in self.timings.items():
+                count, total, longest, buckets = timing
+                fields = [name, handler_name, count, total, longest]
+                fields.extend('<{}:{}'.format(1 << bucket, buckets[bucket])
+                              for bucket in sorted(buckets))
+                print(*fields, sep='\t', file=dump_file)
+            if self._cprofile is not None:
+                print(file=dump_file)
+                stats = pstats.Stats(self._cprofile, stream=dump_file)
+                stats.sort_stats('cumulative').print_stats(40)
+        os.rename(tmp_path, path)
 
 
 def _parse_options(args):
     # Parse the arguments with an OptionParser and return the result.
-    parser = optparse.OptionParser(usage="%prog [options]")
+    parser = optparse.OptionParser(
+        usage="%prog [options] [ctl COMMAND [ARG ...]]")
+    parser.disable_interspersed_args()
     parser.add_option('-c', '--config',
                       dest='conf_name', default='/etc/limitfiles.ini',
                       help="use this configuration file")
@@ -219,7 +1377,36 @@ def _parse_options(args):
     parser.add_option('-p', '--pidfile',
                       dest='pidfile', default=False,
                       help="write PID to this file")
-    return parser.parse_args(args)
+    parser.add_option('-s', '--socket',
+                      dest='socket', default=None,
+                      help="answer control commands on this socket")
+    parser.add_option('--sweep',
+                      dest='sweep', action='store_true', default=False,
+                      help="enforce every limit once and exit")
+    parser.add_option('-j', '--jobs',
+                      dest='jobs', type='int', default=None,
+                      help="scan this many directories at once with --sweep")
+    parser.add_option('--profile-file',
+                      dest='profile_file', default=None,
+                      help="dump profiling results to this file")
+    parser.add_option('--profile-seconds',
+                      dest='profile_seconds', type='float', default=0,
+                      help="run cProfile this long when profiling starts")
+    options, args = parser.parse_args(args)
+    if args and (args[0] != 'ctl'):
+        parser.error("unknown subcommand {!r}".format(args[0]))
+    elif args == ['ctl']:
+        parser.error("ctl needs a control command")
+    if (options.jobs is not None) and (options.jobs < 1):
+        parser.error("--jobs must be at least 1")
+    if (options.socket is None) and options.pidfile:
+        options.socket = os.path.splitext(options.pidfile)[0] + '.sock'
+    if (options.profile_file is None) and options.pidfile:
+        options.profile_file = os.path.splitext(options.pidfile)[0] + '.prof'
+    for name in ['socket', 'profile_file']:
+        if getattr(options, name) is not None:
+            setattr(options, name, os.path.abspath(getattr(options, name)))
+    return options, args
 
 def _config_error(message):
     print("limitfiles configuration error:", message, file=sys.stderr)
@@ -229,44 +1416,214 @@ def _config_warning(sec_name, message):
     print("limitfiles warning: can't watch {}: {}".format(sec_name, message),
           file=sys.stderr)
 
-def _iter_config(config):
+def _parse_bytes(value):
+    # Convert a size like "512", "20M", or "1.5G" to a number of bytes.
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)i?B?\s*$', value, re.I)
+    if match is None:
+        raise ValueError("bad byte size {!r}".format(value))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+def _iter_groups(config):
+    # For each [group:NAME] section in the configuration file, yield a
+    # LimitGroup.
+    for sec_name in config.sections():
+        if not sec_name.startswith('group:'):
+            continue
+        try:
+            max_bytes = _parse_bytes(config.get(sec_name, 'max_bytes'))
+            keep_bytes = None
+            if config.has_option(sec_name, 'keep_bytes'):
+                keep_bytes = _parse_bytes(config.get(sec_name, 'keep_bytes'))
+            yield LimitGroup(sec_name.split(':', 1)[1], max_bytes, keep_bytes)
+        except (configparser.Error, ValueError) as error:
+            _config_warning(sec_name, error)
+
+def _config_archiver(config, sec_name, dir_name):
+    # Return an ArchiveWorker for the section, or None if it doesn't
+    # archive files.  Raise ValueError if its settings are bad.
+    if not config.has_option(sec_name, 'archive'):
+        return None
+    archive_dir = config.get(sec_name, 'archive')
+    if not os.path.isdir(archive_dir):
+        raise ValueError("{} is not a directory".format(archive_dir))
+    elif os.path.realpath(archive_dir) == os.path.realpath(dir_name):
+        raise ValueError("archive must be a different directory")
+    return ArchiveWorker(
+        archive_dir, prefix=sec_name,
+        compression=config.get(sec_name, 'archive_compression', fallback='gz'),
+        queue_size=config.getint(sec_name, 'archive_queue', fallback=10000))
+
+def _config_free_space(config, sec_name, dir_name):
+    # Return a FreeSpaceMonitor for the section, or None if it doesn't
+    # watch free space.  Raise ValueError if its settings are bad.
+    monitor_args = {}
+    for key, getter in [('min_free_bytes', _parse_bytes),
+                        ('target_free_bytes', _parse_bytes),
+                        ('min_free_percent', float),
+                        ('target_free_percent', float),
+                        ('free_space_interval', float)]:
+        if config.has_option(sec_name, key):
+            monitor_args[key] = getter(config.get(sec_name, key))
+    if not ({'min_free_bytes', 'min_free_percent'} & set(monitor_args)):
+        return None
+    if 'free_space_interval' in monitor_args:
+        monitor_args['interval'] = monitor_args.pop('free_space_interval')
+    return FreeSpaceMonitor(dir_name, **monitor_args)
+
+def _iter_config(config, groups={}):
     # For each limit in the configuration file, yield the name of the
     # directory and a dictionary of keyword arguments for LimitProcessor.
+    # `groups` maps group names to LimitGroups that limits can join.
     for sec_name in config.sections():
+        if sec_name.startswith('group:'):
+            continue
         watch_args = {}
         try:
             dir_name = config.get(sec_name, 'directory')
             watch_args['high'] = config.getint(sec_name, 'max')
             watch_args['low'] = config.getint(sec_name, 'keep')
+            watch_args['name'] = sec_name
         except configparser.Error as error:
             _config_warning(sec_name, error)
             continue
         try:
-            watch_args['match'] = config.get(sec_name, 'match')
-        except configparser.NoOptionError:
-            pass
+            for key, getter in [('match', config.get),
+                                ('reconcile_rate', config.getfloat)]:
+                if config.has_option(sec_name, key):
+                    watch_args[key] = getter(sec_name, key)
+            watch_args['archiver'] = _config_archiver(config, sec_name,
+                                                      dir_name)
+            watch_args['free_space'] = _config_free_space(config, sec_name,
+                                                          dir_name)
+            backend = config.get(sec_name, 'backend', fallback='inotify')
+            if backend == 'poll':
+                watch_args['poll_interval'] = config.getfloat(
+                    sec_name, 'poll_interval', fallback=30)
+                watch_args['poll_min_interval'] = config.getfloat(
+                    sec_name, 'poll_min_interval', fallback=1)
+            elif backend != 'inotify':
+                raise ValueError("unknown backend {!r}".format(backend))
+        except (configparser.Error, ValueError) as error:
+            _config_warning(sec_name, error)
+            continue
+        if config.has_option(sec_name, 'group'):
+            group_name = config.get(sec_name, 'group')
+            if group_name not in groups:
+                _config_warning(sec_name,
+                                "no valid group {!r}".format(group_name))
+                continue
+            watch_args['group'] = groups[group_name]
         if not os.path.isdir(dir_name):
             _config_warning(sec_name, "{} is not a directory".format(dir_name))
         else:
             yield dir_name, watch_args
 
-def _build_watch_manager(filename):
-    # Read the named configuration file, install an inotify watch for each
-    # limit in it, and return the new watch manager.
+def _read_config(filename):
+    # Read the named configuration file, and return the parser and a dict
+    # of its LimitGroups by name.
     config = configparser.SafeConfigParser()
     if not config.read(filename):
         _config_error("Could not parse {}".format(filename))
+    return config, {group.name: group for group in _iter_groups(config)}
+
+def _build_watch_manager(filename):
+    # Read the named configuration file, install an inotify watch for each
+    # limit in it, and return the new watch manager.
+    config, groups = _read_config(filename)
     watch_manager = LimitManager()
     success = False
-    for dir_name, watch_args in _iter_config(config):
+    for dir_name, watch_args in _iter_config(config, groups):
         try:
             success = watch_manager.add_watch(dir_name, **watch_args) or success
         except ValueError as error:
             _config_warning(dir_name, error)
     if not success:
         _config_error("No valid sections")
+    for group in groups.values():
+        group.enforce()
     return watch_manager
 
+def _sweep_one(dir_name, watch_args):
+    # Enforce one section's limits, and return its LimitProcessor, or None
+    # if the section is invalid.
+    archiver = watch_args.get('archiver')
+    if archiver is not None:
+        archiver.start()
+    try:
+        return LimitProcessor(dir_name=dir_name, **watch_args)
+    except ValueError as error:
+        _config_warning(watch_args['name'], error)
+        return None
+
+def _sweep(filename, jobs=None):
+    # Enforce every limit in the named configuration file once, scanning
+    # directories in parallel, print a summary of what was removed, and
+    # return an exit status.
+    config, groups = _read_config(filename)
+    sections = list(_iter_config(config, groups))
+    # Groups look across their members' indexes, so join them only after
+    # every scan is done.
+    group_members = [watch_args.pop('group', None)
+                     for dir_name, watch_args in sections]
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(_sweep_one, dir_name, watch_args)
+                   for dir_name, watch_args in sections]
+    processors = [future.result() for future in futures]
+    if not any(processors):
+        _config_error("No valid sections")
+    for group, processor in zip(group_members, processors):
+        if (group is not None) and (processor is not None):
+            group.add(processor)
+    for group in groups.values():
+        group.enforce()
+    total_files = total_bytes = 0
+    for processor in filter(None, processors):
+        # If the archive queue filled up, clean again after it drains,
+        # until the archiver stops deleting files.
+        while processor.archiver is not None:
+            processor.archiver.queue.join()
+            if not processor._collect_archived():
+                break
+            processor._clean_files()
+        total_files += processor.removed_files
+        total_bytes += processor.removed_bytes
+        print(processor.name, processor.removed_files,
+              processor.removed_bytes, sep='\t')
+    print('total', total_files, total_bytes, sep='\t')
+    return 0
+
+def _control_client(path, words):
+    # Send one control command to a running daemon, print the reply,
+    # and return an exit status.
+    if path is None:
+        print("limitfiles: ctl needs a --socket or --pidfile", file=sys.stderr)
+        return 2
+    request = ' '.join(words) + '\n'
+    with contextlib.closing(socket.socket(socket.AF_UNIX,
+                                          socket.SOCK_STREAM)) as sock:
+        try:
+            sock.connect(path)
+            sock.sendall(request.encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+            reply = b''.join(iter(lambda: sock.recv(4096), b''))
+        except OSError as error:
+            print("limitfiles: can't query {}: {}".format(path, error),
+                  file=sys.stderr)
+            return 2
+    reply = reply.decode('utf-8', 'replace')
+    sys.stdout.write(reply)
+    return 1 if reply.startswith('error:') else 0
+
+def _dump_profile(profiler, path):
+    # Write profiling results from a signal handler.  If we can't, warn
+    # rather than letting the error stop the daemon.
+    try:
+        profiler.dump(path)
+    except OSError as error:
+        print("limitfiles warning: can't write profile {}: {}".
+              format(path, error), file=sys.stderr)
+
 def main(args):
     """Run the limitfiles daemon
 
@@ -280,12 +1637,38 @@ def main(args):
       the daemon's behavior.  Refer to the module documentation for valid
       options.
     """
-    global configparser, optparse, sys
-    import configparser, optparse, sys
+    global configparser, optparse, signal, sys
+    import configparser, optparse, signal, sys
     options, args = _parse_options(args)
+    if args:
+        sys.exit(_control_client(options.socket, args[1:]))
+    elif options.sweep:
+        sys.exit(_sweep(options.conf_name, options.jobs))
+    if (options.daemonize and options.pidfile
+          and os.path.lexists(options.pidfile)):
+        print("limitfiles: {} exists; is another daemon running?".
+              format(options.pidfile), file=sys.stderr)
+        sys.exit(1)
     watches = _build_watch_manager(options.conf_name)
-    notifier = pyinotify.Notifier(watches)
-    notifier.loop(daemonize=options.daemonize, pid_file=options.pidfile)
+    notifier = LimitNotifier(watches)
+    control = None
+    if options.socket is not None:
+        try:
+            control = ControlServer(options.socket, notifier)
+        except OSError as error:
+            print("limitfiles: can't listen on {}: {}".
+                  format(options.socket, error), file=sys.stderr)
+            sys.exit(1)
+    if options.profile_file is not None:
+        profiler = HandlerProfiler(watches.processors, options.profile_seconds)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+        signal.signal(signal.SIGUSR2, lambda signum, frame:
+                      _dump_profile(profiler, options.profile_file))
+    try:
+        notifier.loop(daemonize=options.daemonize, pid_file=options.pidfile)
+    finally:
+        if control is not None:
+            control.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2013-2014 World Wide Web Consortium, (Massachusetts
+# Institute of Technology, European Research Consortium for
+# Informatics and Mathematics, Keio University, Beihang). All Rights
+# Reserved. This work is distributed under the W3C® Software License
+# [1] in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.
+#
+# [1] http://www.w3.org/Consortium/Legal/2002/copyright-software-20021231
+#
+# This module depends on the third-party pyinotify module.
+"""Count the stats that rename pairing saves
+
+This records the inotify events from a producer that writes each file
+under a temporary name and then renames it into place.  It replays that
+trace through a LimitProcessor, and through one that treats moves as a
+delete plus a create, and reports how many times each called stat.
+During the replay, stat reports every path as a small regular file, so
+the results don't depend on what's left on disk.
+
+Run it as ``python3 -m tests.bench_renames [FILE_COUNT]``.
+"""
+
+import os
+import pyinotify
+import shutil
+import stat
+import sys
+import tempfile
+import unittest.mock
+
+import limitfiles
+
+FILE_STAT = os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0, 100, 0, 0, 0))
+
+class UnpairedProcessor(limitfiles.LimitProcessor):
+    process_IN_MOVED_FROM = limitfiles.LimitProcessor.process_IN_DELETE
+    process_IN_MOVED_TO = limitfiles.LimitProcessor.process_IN_CREATE
+
+
+class Recorder(pyinotify.ProcessEvent):
+    def my_init(self, events):
+        self.events = events
+
+    def process_default(self, event):
+        self.events.append(event)
+
+
+def record_trace(dir_name, file_count):
+    events = []
+    watch_manager = pyinotify.WatchManager()
+    watch_manager.add_watch(dir_name, limitfiles.LimitManager.mask,
+                            Recorder(events=events))
+    notifier = pyinotify.Notifier(watch_manager, timeout=10)
+    for num in range(file_count):
+        tmp_path = os.path.join(dir_name, '.{}.tmp'.format(num))
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write('x' * 100)
+        os.rename(tmp_path, os.path.join(dir_name, '{}.log'.format(num)))
+        while notifier.check_events(0):
+            notifier.read_events()
+            notifier.process_events()
+    notifier.stop()
+    return events
+
+def count_stats(processor_class, dir_name, events, match):
+    processor = processor_class(dir_name=dir_name, high=len(events) + 1,
+                                low=0, match=match)
+    with unittest.mock.patch.object(limitfiles.os, 'stat',
+                                    return_value=FILE_STAT) as fake_stat:
+        for event in events:
+            processor(event)
+    return fake_stat.call_count
+
+def main(args):
+    file_count = int(args[0]) if args else 1000
+    dir_name = tempfile.mkdtemp(prefix='limitfiles')
+    try:
+        events = record_trace(dir_name, file_count)
+        print("{} events for {} write-then-rename files".
+              format(len(events), file_count))
+        for match in [None, r'\.log$']:
+            unpaired = count_stats(UnpairedProcessor, dir_name, events, match)
+            paired = count_stats(limitfiles.LimitProcessor, dir_name, events,
+                                 match)
+            print("match={!r}: {} stats unpaired, {} paired, {} saved".
+                  format(match, unpaired, paired, unpaired - paired))
+    finally:
+        shutil.rmtree(dir_name, True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -19,7 +19,9 @@ import tempfile
 import shutil
 import unittest
 
-class LimitFilesTestCase(unittest.TestCase):
+import limitfiles
+
+class LimitFilesHelpers(unittest.TestCase):
     def setUp(self):
         self.next_name = 1
         self.workdir = tempfile.mkdtemp(prefix='limitfiles')
@@ -38,15 +40,26 @@ class LimitFilesTestCase(unittest.TestCase):
     def workpath(self, filename):
         return os.path.join(self.workdir, str(filename))
 
-    def touch_files(self, count):
+    def write_file(self, dir_name, name, size):
+        path = os.path.join(dir_name, str(name))
+        stamp = int(name)
+        with open(path, 'wb') as sized_file:
+            sized_file.write(b'x' * size)
+        os.utime(path, (stamp, stamp))
+        return path
+
+    def touch_files(self, count, size=0):
         stop = self.next_name + count
         for name in self.temp_filenames(self.next_name, stop):
-            path = self.workpath(name)
-            stamp = int(name)
-            open(path, 'w').close()
-            os.utime(path, (stamp, stamp))
+            self.write_file(self.workdir, name, size)
         self.next_name = stop
 
+    def make_processor(self, dir_name=None, high=5, low=2, **kwargs):
+        if dir_name is None:
+            dir_name = self.workdir
+        return limitfiles.LimitProcessor(dir_name=dir_name, high=high,
+                                         low=low, **kwargs)
+
     def filename_set(self, seq):
         return frozenset(str(item) for item in seq)
 
@@ -62,6 +75,8 @@ class LimitFilesTestCase(unittest.TestCase):
         raise NotImplementedError(
             "LimitFilesTestCase.assertBadWatch is abstract")
 
+
+class LimitFilesTestCase(LimitFilesHelpers):
     def test_count_limit(self):
         self.watch(high=5, low=2)
         self.touch_files(6)
@@ -98,6 +113,13 @@ class LimitFilesTestCase(unittest.TestCase):
         self.touch_files(2)
         self.assertFilesLeft(range(3, 7))
 
+    def test_limit_respects_renames(self):
+        self.watch(high=5, low=2)
+        self.touch_files(4)
+        os.rename(self.workpath(1), self.workpath(10))
+        self.touch_files(1)
+        self.assertFilesLeft([4, 5], [3])
+
     def test_match_limit(self):
         self.watch(high=2, low=1, match='[1-3]')
         self.touch_files(8)
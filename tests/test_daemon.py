@@ -15,6 +15,9 @@
 
 import atexit
 import functools
+import os
+import shutil
+import signal
 import subprocess
 import sys
 import tempfile
@@ -94,3 +97,106 @@ class TestLimitFilesDaemon(lftests.LimitFilesTestCase):
     def assertBadWatch(self, *args, **kwargs):
         self.watch(**kwargs)
         self.assertNoDaemon()
+
+    def test_control_client(self):
+        sock_name = os.path.join(self.workdir, 'control.sock')
+        self.touch_files(3)
+        self.write_config(high=5, low=2, match=r'^\d+$')
+        self.run_daemon(args=['-f', '-s', sock_name])
+        self.assertControlReply(sock_name, ['index-size'],
+                                "Test Watch\t3\ntotal\t3\n")
+
+    def test_second_daemon_keeps_socket(self):
+        sock_name = os.path.join(self.workdir, 'control.sock')
+        self.touch_files(3)
+        self.write_config(high=5, low=2, match=r'^\d+$')
+        self.run_daemon(args=['-f', '-s', sock_name])
+        self.assertControlReply(sock_name, ['index-size'],
+                                "Test Watch\t3\ntotal\t3\n")
+        second = subprocess.Popen(
+            self.command + ['-f', '-s', sock_name, '-c', self.config.name],
+            stdin=DEV_NULL, stdout=DEV_NULL, stderr=DEV_NULL)
+        self.assertEqual(second.wait(5), 1)
+        self.assertControlReply(sock_name, ['index-size'],
+                                "Test Watch\t3\ntotal\t3\n")
+
+    def test_existing_pidfile_fails_early(self):
+        pid_name = os.path.join(self.workdir, 'daemon.pid')
+        with open(pid_name, 'w') as pid_file:
+            pid_file.write('1\n')
+        self.write_config(high=5, low=2, match=r'^\d+$')
+        self.run_daemon(args=['-p', pid_name])
+        self.assertEqual(self.daemon.wait(5), 1)
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.workdir, 'daemon.sock')))
+
+    @wait_for_daemon
+    def assertControlReply(self, sock_name, words, expected):
+        client = subprocess.Popen(
+            self.command + ['-s', sock_name, 'ctl'] + words,
+            stdout=subprocess.PIPE, stderr=DEV_NULL)
+        output = client.communicate()[0]
+        self.assertEqual(client.returncode, 0)
+        self.assertEqual(output.decode('utf-8'), expected)
+
+    def test_profile_signals(self):
+        prof_dir = tempfile.mkdtemp(prefix='limitfiles')
+        self.addCleanup(shutil.rmtree, prof_dir, True)
+        prof_name = os.path.join(prof_dir, 'daemon.prof')
+        self.write_config(high=5, low=2, match=r'^\d+$')
+        self.run_daemon(args=['-f', '--profile-file', prof_name])
+        # Wait for the daemon to clean files, so it's ready for signals.
+        self.touch_files(6)
+        self.assertFilesLeft([5, 6], [4])
+        self.daemon.send_signal(signal.SIGUSR1)
+        self.touch_files(1)
+        self.assertProfileDump(prof_name, 'process_IN_CREATE')
+
+    def test_profile_dump_failure_keeps_running(self):
+        prof_name = os.path.join(self.workdir, 'missing', 'daemon.prof')
+        self.write_config(high=5, low=2, match=r'^\d+$')
+        self.run_daemon(args=['-f', '--profile-file', prof_name])
+        self.touch_files(6)
+        self.assertFilesLeft([5, 6], [4])
+        self.daemon.send_signal(signal.SIGUSR2)
+        time.sleep(.1)
+        self.assertIsNone(self.daemon.poll())
+        self.touch_files(3)
+        self.assertFilesLeft([8, 9], [7])
+
+    @wait_for_daemon
+    def assertProfileDump(self, prof_name, handler_name):
+        self.daemon.send_signal(signal.SIGUSR2)
+        time.sleep(.1)
+        self.assertTrue(os.path.exists(prof_name))
+        with open(prof_name) as prof_file:
+            self.assertIn('\t{}\t1\t'.format(handler_name), prof_file.read())
+
+    def test_sweep(self):
+        self.touch_files(6)
+        self.write_config(high=5, low=2)
+        sweep = subprocess.Popen(
+            self.command + ['--sweep', '-c', self.config.name],
+            stdout=subprocess.PIPE, stderr=DEV_NULL)
+        output = sweep.communicate()[0].decode('utf-8')
+        self.assertEqual(sweep.returncode, 0)
+        self.assertEqual(output, "Test Watch\t4\t0\ntotal\t4\t0\n")
+        self.assertFilesLeft([5, 6])
+
+    def test_sweep_without_valid_sections_fails(self):
+        self.write_config(high=2, low=4)
+        sweep = subprocess.Popen(
+            self.command + ['--sweep', '-c', self.config.name],
+            stdout=DEV_NULL, stderr=DEV_NULL)
+        self.assertGreater(sweep.wait(), 0)
+
+    def test_sweep_bad_jobs_fails(self):
+        self.write_config(high=5, low=2)
+        for jobs in ['0', '-1']:
+            sweep = subprocess.Popen(
+                self.command + ['--sweep', '-j', jobs, '-c', self.config.name],
+                stdout=DEV_NULL, stderr=subprocess.PIPE)
+            error = sweep.communicate()[1].decode('utf-8')
+            self.assertEqual(sweep.returncode, 2)
+            self.assertIn("--jobs must be at least 1", error)
+            self.assertNotIn("Traceback", error)
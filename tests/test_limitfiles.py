@@ -13,17 +13,25 @@
 # Written December 2013 by Brett Smith <brett@w3.org>
 # This module depends on the third-party pyinotify module.
 
+import collections
+import errno
+import io
+import os
 import pyinotify
+import shutil
+import socket
+import tarfile
 import tempfile
+import unittest.mock
 
 import limitfiles
 import tests.limitfiles_common as lftests
 
-class TestLimitFiles(lftests.LimitFilesTestCase):
+class LimitNotifierHelpers(lftests.LimitFilesHelpers):
     def setUp(self):
         super().setUp()
         self.limits = limitfiles.LimitManager()
-        self.notifier = pyinotify.Notifier(self.limits, timeout=10)
+        self.notifier = limitfiles.LimitNotifier(self.limits, timeout=10)
 
     def tearDown(self):
         self.notifier.stop()
@@ -41,3 +49,491 @@ class TestLimitFiles(lftests.LimitFilesTestCase):
     def watch(self, **kwargs):
         dir_name = kwargs.pop('dir_name', self.workdir)
         return self.limits.add_watch(dir_name, **kwargs)
+
+
+class TestLimitFiles(LimitNotifierHelpers, lftests.LimitFilesTestCase):
+    pass
+
+
+class TestPolling(LimitNotifierHelpers, lftests.LimitFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = 0
+
+    def watch(self, **kwargs):
+        kwargs.setdefault('poll_interval', 10)
+        return super().watch(**kwargs)
+
+    def assertFilesLeft(self, *args):
+        # Jump past the longest poll interval so every processor polls.
+        self.clock += 10
+        for processor in self.limits.processors.values():
+            processor.tick(self.clock)
+        lftests.LimitFilesHelpers.assertFilesLeft(self, *args)
+
+    def test_poll_backs_off_without_changes(self):
+        self.watch(high=5, low=2, poll_min_interval=1)
+        processor = self.limits.processors[self.workdir]
+        os.utime(self.workdir, (1, 1))
+        delays = [processor.tick(now) for now in range(0, 40, 10)]
+        self.assertEqual(delays, [1, 2, 4, 8])
+        self.touch_files(1)
+        os.utime(self.workdir, (2, 2))
+        self.assertEqual(processor.tick(40), 4)
+        self.assertEqual(set(processor.files), {self.workpath(1)})
+
+    def test_poll_error_keeps_index(self):
+        self.touch_files(3)
+        self.watch(high=5, low=2, poll_min_interval=1)
+        processor = self.limits.processors[self.workdir]
+        stale = OSError(errno.ESTALE, os.strerror(errno.ESTALE))
+        with unittest.mock.patch.object(limitfiles.os, 'stat',
+                                        side_effect=stale), \
+             unittest.mock.patch('sys.stderr', new=io.StringIO()) as stderr:
+            self.assertEqual(processor.tick(0), 10)
+            self.assertEqual(processor.tick(10), 10)
+        self.assertEqual(len(processor.files), 3)
+        self.assertEqual(stderr.getvalue().count('warning'), 1)
+        self.assertEqual(processor.tick(20), 5)
+
+    def test_poll_adds_no_watch(self):
+        self.assertEqual(self.watch(high=5, low=2), {self.workdir: None})
+        self.assertEqual(self.limits.watches, {})
+
+    def test_bad_poll_interval_fails(self):
+        self.assertBadWatch(high=5, low=2, poll_interval=1,
+                            poll_min_interval=2)
+
+
+class TestControlServer(LimitNotifierHelpers):
+    def setUp(self):
+        super().setUp()
+        self.sock_name = os.path.join(self.workdir, 'control.sock')
+        self.watch(high=5, low=2, name="Test Watch", match=r'^\d+$')
+        self.control = limitfiles.ControlServer(self.sock_name, self.notifier)
+
+    def tearDown(self):
+        self.control.close()
+        super().tearDown()
+
+    def command(self, line):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.sock_name)
+            client.sendall(line.encode('utf-8') + b'\n')
+            client.setblocking(False)
+            reply = b''
+            for _ in range(100):
+                self.notifier.check_events()
+                try:
+                    data = client.recv(4096)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                reply += data
+        return reply.decode('utf-8')
+
+    def test_status(self):
+        self.touch_files(3)
+        self.notifier.flush_events()
+        self.assertEqual(self.command('status'),
+                         "Test Watch\t{}\t3\t2\t5\n".format(self.workdir))
+
+    def test_top_oldest(self):
+        self.touch_files(4)
+        self.notifier.flush_events()
+        self.assertEqual(self.command('top-oldest 2 Test Watch'),
+                         "1.0\t{}\n2.0\t{}\n".format(self.workpath(1),
+                                                       self.workpath(2)))
+
+    def test_index_size_after_flush(self):
+        self.touch_files(3)
+        self.command('flush')
+        self.assertEqual(self.command('index-size'),
+                         "Test Watch\t3\ntotal\t3\n")
+
+    def test_force_rescan(self):
+        self.touch_files(3)
+        self.notifier.flush_events()
+        os.unlink(self.workpath(1))
+        self.limits.processors["Test Watch"].files[self.workpath(9)] = 9
+        self.assertEqual(self.command('force-rescan Test Watch'), "ok\t2\n")
+
+    def test_bad_commands(self):
+        for line in ['bogus', 'top-oldest x Test Watch', 'force-rescan nope']:
+            self.assertTrue(self.command(line).startswith('error: '), line)
+
+    def test_live_socket_not_replaced(self):
+        with self.assertRaises(OSError):
+            limitfiles.ControlServer(self.sock_name, self.notifier)
+        self.assertEqual(self.command('index-size'),
+                         "Test Watch\t0\ntotal\t0\n")
+
+    def test_stale_socket_replaced(self):
+        self.notifier.remove_handler(self.control.socket.fileno())
+        self.control.socket.close()
+        self.control = limitfiles.ControlServer(self.sock_name, self.notifier)
+        self.assertEqual(self.command('index-size'),
+                         "Test Watch\t0\ntotal\t0\n")
+
+
+class TestReconcile(lftests.LimitFilesHelpers):
+    def run_pass(self, processor, ticks=3):
+        for now in range(ticks):
+            processor.tick(now)
+
+    def test_reconcile_finds_missed_files(self):
+        processor = self.make_processor(reconcile_rate=1000)
+        self.touch_files(6)
+        self.assertEqual(processor.files, {})
+        self.run_pass(processor)
+        self.assertFilesLeft([5, 6])
+        self.assertEqual(set(processor.files),
+                         {self.workpath(5), self.workpath(6)})
+
+    def test_reconcile_drops_missed_deletes(self):
+        self.touch_files(2)
+        processor = self.make_processor(reconcile_rate=1000)
+        os.unlink(self.workpath(1))
+        self.run_pass(processor)
+        self.assertEqual(set(processor.files), {self.workpath(2)})
+
+    def test_reconcile_respects_rate(self):
+        self.touch_files(4)
+        processor = self.make_processor(high=10, low=5, reconcile_rate=2)
+        processor.files.clear()
+        processor.tick(0)
+        processor.tick(1)
+        self.assertEqual(len(processor.files), 2)
+
+    def test_reconcile_off_by_default(self):
+        processor = self.make_processor(reconcile_rate=0)
+        self.assertIsNone(processor.tick(0))
+
+    def test_negative_rate_fails(self):
+        self.assertRaises(ValueError, self.make_processor, reconcile_rate=-1)
+
+
+class TestLimitGroup(lftests.LimitFilesHelpers):
+    def setUp(self):
+        super().setUp()
+        self.otherdir = tempfile.mkdtemp(prefix='limitfiles')
+
+    def tearDown(self):
+        shutil.rmtree(self.otherdir, True)
+        super().tearDown()
+
+    def test_group_deletes_oldest_across_members(self):
+        for name in [1, 3, 5]:
+            self.write_file(self.workdir, name, 10)
+        for name in [2, 4, 6]:
+            self.write_file(self.otherdir, name, 10)
+        group = limitfiles.LimitGroup('test', 40, 30)
+        processors = [self.make_processor(dir_name, high=100, low=50)
+                      for dir_name in [self.workdir, self.otherdir]]
+        for processor in processors:
+            group.add(processor)
+        self.assertEqual(group.total_bytes, 60)
+        group.enforce()
+        self.assertEqual(group.total_bytes, 30)
+        self.assertFilesLeft([5])
+        self.assertEqual(sorted(os.listdir(self.otherdir)), ['4', '6'])
+        self.write_file(self.workdir, 7, 20)
+        processors[0]._record_file('7')
+        processors[0]._clean_files()
+        self.assertFilesLeft([7])
+        self.assertEqual(os.listdir(self.otherdir), ['6'])
+        self.assertEqual(list(processors[1].iter_oldest()),
+                         [(6, os.path.join(self.otherdir, '6'))])
+
+    def test_iter_oldest_restores_heap(self):
+        for name in [3, 1, 2]:
+            self.write_file(self.workdir, name, 10)
+        processor = self.make_processor(high=100, low=50)
+        oldest = processor.iter_oldest()
+        self.assertEqual(next(oldest), (1, self.workpath(1)))
+        oldest.close()
+        processor.remove_file(self.workpath(2))
+        self.assertEqual([path for mtime, path in processor.iter_oldest()],
+                         [self.workpath(1), self.workpath(3)])
+
+    def test_failed_watch_skips_group(self):
+        group = limitfiles.LimitGroup('test', 10)
+        limits = limitfiles.LimitManager()
+        self.addCleanup(limits.close)
+        missing = os.path.join(self.workdir, 'missing')
+        result = limits.add_watch(missing, group=group, high=100, low=50)
+        self.assertLess(result[missing], 0)
+        limits.add_watch(self.otherdir, group=group, high=100, low=50)
+        self.assertEqual([processor.dir_name for processor in group.members],
+                         [self.otherdir])
+
+    def test_default_keep_bytes(self):
+        self.assertEqual(limitfiles.LimitGroup('test', 100).keep_bytes, 90)
+
+    def test_group_under_limit(self):
+        self.write_file(self.workdir, 1, 10)
+        group = limitfiles.LimitGroup('test', 10)
+        group.add(self.make_processor(high=100, low=50))
+        group.enforce()
+        self.assertFilesLeft([1])
+
+    def test_bad_group_limits(self):
+        self.assertRaises(ValueError, limitfiles.LimitGroup, 'test', 10, 20)
+        self.assertRaises(ValueError, limitfiles.LimitGroup, 'test', 10, -1)
+
+    def test_parse_bytes(self):
+        for text, expected in [('512', 512), ('2K', 2048), ('1.5m', 1572864),
+                               ('3GiB', 3 << 30)]:
+            self.assertEqual(limitfiles._parse_bytes(text), expected)
+        self.assertRaises(ValueError, limitfiles._parse_bytes, '12Q')
+
+
+class TestArchiveWorker(lftests.LimitFilesHelpers):
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = tempfile.mkdtemp(prefix='limitfiles')
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir, True)
+        super().tearDown()
+
+    def archived_names(self):
+        names = []
+        for archive_name in os.listdir(self.archive_dir):
+            with tarfile.open(os.path.join(self.archive_dir,
+                                           archive_name)) as tar:
+                names.extend(tar.getnames())
+        return sorted(names, key=int)
+
+    def test_archive_before_delete(self):
+        self.touch_files(6)
+        self.archiver = limitfiles.ArchiveWorker(self.archive_dir)
+        processor = self.make_processor(archiver=self.archiver)
+        self.assertEqual(set(processor.files),
+                         {self.workpath(5), self.workpath(6)})
+        self.assertFilesLeft(range(1, 7))
+        self.assertEqual(processor.removed_files, 0)
+        processor.tick(0)
+        self.archiver.queue.join()
+        self.assertFilesLeft([5, 6])
+        self.assertEqual(self.archived_names(), ['1', '2', '3', '4'])
+        processor.tick(0)
+        self.assertEqual(processor.removed_files, 4)
+
+    def test_full_queue_cleans_after_draining(self):
+        self.touch_files(20)
+        self.archiver = limitfiles.ArchiveWorker(
+            self.archive_dir, queue_size=3, compression='xz')
+        processor = self.make_processor(archiver=self.archiver)
+        self.assertEqual(len(processor.files), 17)
+        for _ in range(50):
+            if processor.tick(0) is None:
+                break
+            self.archiver.queue.join()
+        self.assertFilesLeft([19, 20], range(1, 19))
+        self.assertEqual(self.archived_names(), list(map(str, range(1, 19))))
+        self.assertEqual(processor.removed_files, 18)
+
+    def test_files_left_in_place_are_indexed_again(self):
+        self.touch_files(6)
+        self.archiver = limitfiles.ArchiveWorker(self.archive_dir)
+        processor = self.make_processor(archiver=self.archiver)
+        self.archiver._archive_batch = lambda batch: set()
+        self.assertEqual(len(processor.files), 2)
+        processor.tick(0)
+        self.archiver.queue.join()
+        self.assertIsNone(processor.tick(0))
+        self.assertEqual(set(processor.files),
+                         {self.workpath(num) for num in range(1, 7)})
+        self.assertEqual(processor.total_bytes, 0)
+        self.assertEqual(processor.removed_files, 0)
+
+    def test_shared_prefix_keeps_every_archive(self):
+        self.touch_files(2)
+        workers = [limitfiles.ArchiveWorker(self.archive_dir, prefix=prefix)
+                   for prefix in ['spool a', 'spool/a']]
+        for worker, num in zip(workers, [1, 2]):
+            self.assertEqual(worker._archive_batch([self.workpath(num)]),
+                             {self.workpath(num)})
+        self.assertFilesLeft([], [1, 2])
+        self.assertEqual(len(os.listdir(self.archive_dir)), 2)
+        self.assertEqual(self.archived_names(), ['1', '2'])
+
+    def assertChangedFileAbortsBatch(self, change):
+        archiver = limitfiles.ArchiveWorker(self.archive_dir)
+        self.touch_files(3, size=1024)
+        paths = [self.workpath(num) for num in range(1, 4)]
+        real_addfile = tarfile.TarFile.addfile
+        def addfile(tar, tarinfo, fileobj=None):
+            if tarinfo.name == '2':
+                change(self.workpath(2))
+            return real_addfile(tar, tarinfo, fileobj)
+        with unittest.mock.patch.object(tarfile.TarFile, 'addfile', addfile):
+            archiver._archive_batch(paths)
+        self.assertFilesLeft([1, 2, 3])
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_shrunk_file_aborts_batch(self):
+        self.assertChangedFileAbortsBatch(lambda path: os.truncate(path, 10))
+
+    def test_grown_file_aborts_batch(self):
+        def grow(path):
+            with open(path, 'ab') as source:
+                source.write(b'y' * 1024)
+        self.assertChangedFileAbortsBatch(grow)
+
+    def test_bad_compression_fails(self):
+        self.assertRaises(ValueError, limitfiles.ArchiveWorker,
+                          self.archive_dir, compression='rar')
+
+
+class TestRenamePairing(lftests.LimitFilesHelpers):
+    def event(self, mask, name, cookie):
+        return pyinotify.Event({'wd': 1, 'mask': mask, 'cookie': cookie,
+                                'name': name, 'path': self.workdir})
+
+    def test_paired_move_skips_stat(self):
+        self.touch_files(2)
+        processor = self.make_processor()
+        os.rename(self.workpath(1), self.workpath(9))
+        with unittest.mock.patch.object(limitfiles.os, 'stat') as stat:
+            processor(self.event(pyinotify.IN_MOVED_FROM, '1', 7))
+            processor(self.event(pyinotify.IN_MOVED_TO, '9', 7))
+        self.assertFalse(stat.called)
+        self.assertEqual(processor.files,
+                         {self.workpath(2): 2, self.workpath(9): 1})
+        self.assertEqual(processor.moves_paired, 1)
+
+    def test_unpaired_move_expires(self):
+        self.touch_files(1)
+        processor = self.make_processor()
+        processor(self.event(pyinotify.IN_MOVED_FROM, '1', 7))
+        self.assertEqual(processor.files, {})
+        self.assertIsNotNone(processor.tick(0))
+        self.assertIsNone(processor.tick(processor.move_timeout + 1e6))
+        processor(self.event(pyinotify.IN_MOVED_TO, '1', 7))
+        self.assertEqual(processor.files, {self.workpath(1): 1})
+        self.assertEqual(processor.moves_paired, 0)
+
+    def test_move_expiry_stops_at_first_live_move(self):
+        class LookCounter(collections.OrderedDict):
+            looked = 0
+            def __iter__(self):
+                for cookie in super().__iter__():
+                    self.looked += 1
+                    yield cookie
+            def items(self):
+                for item in super().items():
+                    self.looked += 1
+                    yield item
+        processor = self.make_processor()
+        processor._moves = LookCounter(
+            (cookie, (cookie, None)) for cookie in range(1000))
+        self.assertEqual(processor._expire_moves(3 + processor.move_timeout),
+                         1)
+        self.assertEqual(list(processor._moves)[:1], [4])
+        processor._moves.looked = 0
+        processor._expire_moves(3 + processor.move_timeout)
+        self.assertEqual(processor._moves.looked, 1)
+
+    def test_moves_expire_without_tick(self):
+        self.touch_files(2)
+        processor = self.make_processor()
+        processor.move_timeout = 0
+        processor(self.event(pyinotify.IN_MOVED_FROM, '1', 7))
+        processor(self.event(pyinotify.IN_MOVED_FROM, '2', 8))
+        self.assertEqual(list(processor._moves), [8])
+        processor(self.event(pyinotify.IN_MOVED_TO, '9', 9))
+        self.assertEqual(processor._moves, {})
+
+
+class TestFreeSpace(lftests.LimitFilesHelpers):
+    def fake_statvfs(self, free, size=1000):
+        return unittest.mock.patch.object(
+            limitfiles.os, 'statvfs', return_value=os.statvfs_result(
+                (1, 1, size, free, free, 0, 0, 0, 0, 255)))
+
+    def watch_space(self, **kwargs):
+        monitor = limitfiles.FreeSpaceMonitor(self.workdir, interval=3600,
+                                              **kwargs)
+        return self.make_processor(high=100, low=50, free_space=monitor)
+
+    def test_low_space_deletes_to_target(self):
+        self.touch_files(5, size=10)
+        with self.fake_statvfs(25) as statvfs:
+            self.watch_space(min_free_bytes=30, target_free_bytes=45)
+        self.assertEqual(statvfs.call_count, 1)
+        self.assertFilesLeft([3, 4, 5])
+
+    def test_percent_watermark(self):
+        self.touch_files(5, size=10)
+        with self.fake_statvfs(25):
+            self.watch_space(min_free_percent=3, target_free_percent=4)
+        self.assertFilesLeft([3, 4, 5])
+
+    def test_enough_space(self):
+        self.touch_files(5, size=10)
+        with self.fake_statvfs(30):
+            self.watch_space(min_free_bytes=30, target_free_bytes=45)
+        self.assertFilesLeft(range(1, 6))
+
+    def test_estimate_tracks_new_files(self):
+        self.touch_files(2, size=10)
+        with self.fake_statvfs(100):
+            processor = self.watch_space(min_free_bytes=95)
+            self.touch_files(1, size=10)
+            processor._record_file('3')
+            processor._clean_files()
+        self.assertFilesLeft([2, 3])
+
+    def test_bad_watermarks_fail(self):
+        for kwargs in [{'min_free_bytes': 10, 'target_free_bytes': 5},
+                       {'min_free_percent': 101},
+                       {'min_free_percent': 5, 'target_free_percent': 1}]:
+            self.assertRaises(ValueError, limitfiles.FreeSpaceMonitor,
+                              self.workdir, **kwargs)
+
+
+class TestHandlerProfiler(LimitNotifierHelpers):
+    def setUp(self):
+        super().setUp()
+        self.watch(high=5, low=2)
+        self.processor = self.limits.processors[self.workdir]
+        self.profiler = limitfiles.HandlerProfiler(self.limits.processors)
+
+    def test_profiler_times_handlers(self):
+        self.profiler.toggle()
+        self.touch_files(6)
+        self.assertFilesLeft([5, 6], [4])
+        self.profiler.toggle()
+        self.touch_files(1)
+        self.assertFilesLeft([6, 7], [4, 5])
+        dump_name = self.workpath('dump.prof')
+        self.profiler.dump(dump_name)
+        with open(dump_name) as dump_file:
+            lines = [line.split('\t') for line in dump_file]
+        os.unlink(dump_name)
+        counts = {fields[1]: int(fields[2]) for fields in lines}
+        self.assertEqual(counts['process_IN_CREATE'], 6)
+        self.assertEqual(counts['process_IN_Q_OVERFLOW'], 0)
+        self.assertGreaterEqual(counts['_clean_files'], 6)
+
+    def test_disabled_profiler_leaves_no_wrappers(self):
+        self.profiler.enable()
+        self.assertIn('process_IN_CREATE', vars(self.processor))
+        self.profiler.disable()
+        for name in self.profiler.handler_names:
+            self.assertNotIn(name, vars(self.processor))
+
+    def test_cprofile_capture(self):
+        self.profiler.cprofile_seconds = 60
+        self.profiler.enable()
+        self.touch_files(1)
+        self.assertFilesLeft([1])
+        self.profiler.disable()
+        dump_name = self.workpath('dump.prof')
+        self.profiler.dump(dump_name)
+        with open(dump_name) as dump_file:
+            self.assertIn('_record_file', dump_file.read())
+        os.unlink(dump_name)